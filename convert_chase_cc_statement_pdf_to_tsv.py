@@ -179,6 +179,7 @@
 
 from sys import exit, stdout
 
+from os import fdopen
 from os.path import splitext
 
 from subprocess import Popen, PIPE
@@ -191,22 +192,17 @@ from re import escape  as regex_escape
 ###############################################################################
 # Utilities.
 
-def crange(start, end):
-  """Returns the range [start, end]. Equivalent to `range(start, end + 1)`."""
-  return range(start, end + 1)
-
-def reduce(reduction, initial_value, sequence):
-  """Compute a sum of `sequence` using the binary function `reduction`.
-
-  `initial_value` is the left-hand input to the first call to `reduction`.
-  """
-  for item in sequence:
-    initial_value = reduction(initial_value, item)
-  return initial_value
+# Converts a `str` of exactly two digits to an `int`. Dates are made of two
+# digit numbers, and looking them up in a table is cheaper than calling `int`.
+two_digits_to_int = dict(map(lambda n: ("%02d" % n, n), range(100))).__getitem__
 
 def str_to_float(string):
   """Converts a `str` representing a number to a `float`. Supports thousands separators."""
-  return float(string.replace(",", ""))
+  # Most amounts are less than 1,000, so skip the copy when there are no
+  # thousands separators to delete.
+  if "," in string:
+    string = string.translate(None, ",")
+  return float(string)
 
 class string_escaper(object):
   """Escape all control characters in `string`.
@@ -214,21 +210,43 @@ class string_escaper(object):
   Loosely based on: https://stackoverflow.com/a/93029/3304954
   """
 
-  control_char_engine = regex_compile(u"([{0}])".format(regex_escape(
-    "".join(map(unichr, range(0, 32) + range(127, 160)))
+  control_chars = "".join(map(chr, range(0, 32) + range(127, 160)))
+
+  control_char_engine = regex_compile("([{0}])".format(regex_escape(
+    control_chars
   )))
 
+  # The escape sequence of each control character, so that they are formatted
+  # once instead of on every substitution.
+  control_char_escapes = dict(map(
+      lambda char: (char, r'\x{0:02x}'.format(ord(char)))
+    , control_chars
+  ))
+
   def __call__(self, string):
+    # Almost no lines contain control characters, so search for one before
+    # paying for a substitution.
+    if self.control_char_engine.search(string) is None:
+      return string
+
     return self.control_char_engine.sub(
-        lambda match: r'\x{0:02x}'.format(ord(match.group()))
+        lambda match: self.control_char_escapes[match.group()]
       , string
     )
 
 escape_str = string_escaper()
 
 def enum(*states):
-  """Create a new class that has an attribute of unique type for each `str` in `states`."""
-  attrs = dict(map(lambda n: (n, type(n, (), dict(__repr__ = lambda s: n))()), states))
+  """Create a new class that has an attribute for each `str` in `states`.
+
+  Each attribute is an `int`, numbered from 0 in the order of `states`, so the
+  attributes can be compared cheaply and used as list indices. They are
+  printed as their names.
+  """
+  # All the attributes share one type, which looks up their names by value.
+  state = type("state", (int,), dict(__repr__ = lambda s: states[s],
+                                     __str__  = lambda s: states[s]))
+  attrs = dict((n, state(value)) for value, n in enumerate(states))
   return type("enum", (), attrs)
 
 ###############################################################################
@@ -285,15 +303,19 @@ class month_day(object):
     day   (int) : The day of the month (between 1 and 31).
   """
 
+  # Every transaction record has at least one date, so we avoid allocating a
+  # `__dict__` for each of them.
+  __slots__ = ("month", "day")
+
   def __init__(self, month, day):
     self.month = month
     self.day   = day
 
-    assert self.month in crange(1, 12), ("Invalid month in date `{0}`.").format(self)
-    assert self.day   in crange(1, 31), ("Invalid day in date `{0}`.").format(self)
+    assert 1 <= self.month <= 12, ("Invalid month in date `{0}`.").format(self)
+    assert 1 <= self.day   <= 31, ("Invalid day in date `{0}`.").format(self)
 
   def __str__(self):
-    return '{0:0>2d}/{1:0>2d}'.format(self.month, self.day)
+    return "%02d/%02d" % (self.month, self.day)
 
 class month_day_year(month_day):
   """A MM/DD/YY date.
@@ -304,6 +326,8 @@ class month_day_year(month_day):
     year  (int) : The year of the century (between 0 and 99).
   """
 
+  __slots__ = ("year",)
+
   def __init__(self, month, day, year):
     # Must be done before we call the base class constructor. Otherwise if an
     # assertion fails in the base class constructor, the overridden __str__ 
@@ -312,10 +336,10 @@ class month_day_year(month_day):
 
     super(month_day_year, self).__init__(month, day)
 
-    assert self.year in crange(0, 99), ("Invalid year in date `{0}`.").format(self)
+    assert 0 <= self.year  <= 99, ("Invalid year in date `{0}`.").format(self)
 
   def __str__(self):
-    return "{0:0>2d}/{1:0>2d}/{2:0>2d}".format(self.month, self.day, self.year)
+    return "%02d/%02d/%02d" % (self.month, self.day, self.year)
 
 class period(object):
   """A range of time defined by two MM/DD/YY dates (`month_day_year`s).
@@ -327,6 +351,8 @@ class period(object):
     closing (:obj:`month_day_year`) : The ending date.
   """
 
+  __slots__ = ("opening", "closing")
+
   def __init__(self, opening, closing):
     self.opening = opening
     self.closing = closing
@@ -342,16 +368,20 @@ class transit_leg(object):
     arrival   (str) : The arrival point, described by three letters.
   """
 
+  __slots__ = ("code", "departure", "arrival")
+
   def __init__(self, code, departure, arrival):
     self.code   = code
     self.departure = departure
     self.arrival = arrival
 
-    assert type(self.code)      is str and len(self.code) == 1,       \
+    # The fields are always `str`s captured by the transit leg rule, so we only
+    # check their lengths.
+    assert len(self.code)      == 1,                                  \
       ("Invalid code `{0}` in transit leg `{1}`").format(self.code, self)
-    assert type(self.departure) is str and len(self.departure) == 3,  \
+    assert len(self.departure) == 3,                                  \
       ("Invalid departure `{0}` in transit leg `{1}`").format(self.departure, self)
-    assert type(self.arrival)   is str and len(self.arrival) == 3,    \
+    assert len(self.arrival)   == 3,                                  \
       ("Invalid arrival `{0}` in transit leg `{1}`").format(self.arrival, self)
 
   def __str__(self):
@@ -371,13 +401,17 @@ class domestic_transaction_record(object):
       Transaction amount in domestic currency. 
   """
 
+  # Like dates, one of these is allocated for every transaction record, so we
+  # avoid allocating a `__dict__` for each of them.
+  __slots__ = ("date", "description", "amount")
+
   def __init__(self, date, description, amount):
     self.date        = date
     self.description = description
     self.amount      = amount
 
   def __str__(self):
-    return "DOMESTIC\t{0}\t{1}\t{2:.2f}".format(
+    return "DOMESTIC\t%s\t%s\t%.2f" % (
         self.date
       , self.description
       , self.amount
@@ -403,6 +437,9 @@ class foreign_transaction_record(domestic_transaction_record):
       Currency exchange rate.
   """
 
+  __slots__ = ("exchange_date", "exchange_currency",
+               "exchange_amount", "exchange_rate")
+
   def __init__(self, date, description, amount,
                      exchange_date, exchange_currency,
                      exchange_amount, exchange_rate):
@@ -414,7 +451,7 @@ class foreign_transaction_record(domestic_transaction_record):
     super(foreign_transaction_record, self).__init__(date, description, amount)
 
   def __str__(self):
-    return "FOREIGN\t{0}\t{1}\t{2:.2f}\t{3}\t{4}\t{5:.2f}\t{6:f}".format(
+    return "FOREIGN\t%s\t%s\t%.2f\t%s\t%s\t%.2f\t%f" % (
         self.date
       , self.description
       , self.amount
@@ -441,6 +478,8 @@ class transit_transaction_record(domestic_transaction_record):
       A non-empty list of `transit_leg`s describing the trip. 
   """
 
+  __slots__ = ("transit_id", "transit_legs")
+
   def __init__(self, date, description, amount,
                      transit_id, transit_legs):
     self.transit_id   = transit_id
@@ -449,16 +488,12 @@ class transit_transaction_record(domestic_transaction_record):
     super(transit_transaction_record, self).__init__(date, description, amount)
 
   def __str__(self):
-    return "TRANSIT\t{0}\t{1}\t{2:.2f}\t\t\t\t\t{3:0>6d}\t{4}".format(
+    return "TRANSIT\t%s\t%s\t%.2f\t\t\t\t\t%06d\t%s" % (
         self.date
       , self.description
       , self.amount
       , self.transit_id
-      , reduce(
-            lambda x, y: "{0} {1}".format(str(x), str(y))
-          , ""
-          , self.transit_legs
-        )
+      , " ".join(map(str, self.transit_legs))
     )
 
 ###############################################################################
@@ -479,42 +514,80 @@ class io_manager(object):
     line = iom[0]     # Access the next line of input without consuming it.
     line = iom[1]     # Access the 2nd line of input without consuming it.
     line = iom[n]     # Access the `(n + 1)`th line of input without consuming it.
+    iom.consume(n)    # Consume the next `n` lines of input after peeking them.
 
-  `io_manager` also maintains a `dict` mapping months to years, which is used
+  `io_manager` also maintains a mapping of months to years, which is used
   to convert `month_day`s to `month_day_year`s.
 
+  Output is accumulated in a list and written to the output TSV file in
+  batches of at least `output_batch_size` bytes; call `flush` to write out any
+  pending output.
+
   Attributes:
     output_tsv_file    (file) : File object that the output TSV is written to.
+    output_sequence    (list) : List of strings waiting to be written to
+      `output_tsv_file`.
+    output_sequence_size (int) : Total length of the strings in
+      `output_sequence`.
     input_sequence     (list) : List of lines (`str`) from the input PDF.
-    month_year_mapping (dict) : Mapping used to add years to transaction records.
+    input_position     (int)  : Index of the next line in `input_sequence`.
+    month_year_mapping (list) : Mapping used to add years to transaction records.
+    dates              (dict) : The `month_day_year`s returned by `date`, keyed
+      by month and day.
   """
 
+  # Size of the output TSV file buffer. The output is small, so with a buffer
+  # this large it is usually written with a single syscall.
+  output_buffer_size = 2 ** 20
+
+  # Number of bytes accumulated in `output_sequence` before they are written
+  # to the output TSV file.
+  output_batch_size = 2 ** 16
+
   def __init__(self, input_pdf_name, output_tsv_name = None):
     if   output_tsv_name == "-":  # Output to stdout.
-      self.output_tsv_file = stdout
+      self.output_tsv_file = fdopen(stdout.fileno(), "w",
+                                    self.output_buffer_size)
     elif output_tsv_name is None: # Output to file: input prefix + '.tsv'.
-      self.output_tsv_file = open(splitext(input_pdf_name)[0] + ".tsv", "w")
+      self.output_tsv_file = open(splitext(input_pdf_name)[0] + ".tsv", "w",
+                                  self.output_buffer_size)
     else:                         # Output to file: user-specified.
-      self.output_tsv_file = open(output_tsv_name, "w")
+      self.output_tsv_file = open(output_tsv_name, "w",
+                                  self.output_buffer_size)
+
+    self.output_sequence      = []
+    self.output_sequence_size = 0
 
     # Launch a subprocess that extracts the text from the input PDF.
     pdftotext = Popen(["pdftotext", "-raw", input_pdf_name, "-"], stdout = PIPE)
 
-    # Split the input into an list of lines.
+    # Split the input into an list of lines. We split on "\n" only (unlike
+    # `splitlines`, which also splits on a lone "\r" inside a record), and drop
+    # the spurious empty line after a final newline character.
     self.input_sequence = pdftotext.communicate()[0].split("\n")
 
-    # Reverse the list of lines because we'll be popping lines from the list
-    # starting with the 1st, and removing from the end is more efficient - O(1)
-    # vs O(N) (I don't actually know if python lists are implemented as dynamic
-    # arrays, but I assume so).
-    self.input_sequence.reverse()
+    if self.input_sequence[-1] == "":
+      self.input_sequence.pop()
+
+    # Index of the next line of input. Lines are consumed by advancing this
+    # cursor instead of removing them from the list, so consuming a line and
+    # looking ahead are both O(1) and the list never has to be reordered.
+    self.input_position = 0
 
     # Transaction records don't have the year of the transaction, only have the
     # month and day. We parse the period of the statement, which does have the
     # year (although not the century). We create a mapping of month to year from
     # the statement period dates and then use it to look up the year of each
     # transaction.
-    self.month_year_mapping = {}
+    #
+    # The mapping is a list indexed by month (1 through 12), with None for the
+    # months that have no mapping, so looking up a year is a single index.
+    self.month_year_mapping = [None] * 13
+
+    # Many transactions share the same date, so we create one `month_day_year`
+    # for each month and day and reuse it. It is cleared whenever the month to
+    # year mapping changes.
+    self.dates = {}
 
   #############################################################################
   # Input Stream
@@ -534,10 +607,24 @@ class io_manager(object):
     Raises:
       StopIteration : If there is no more input.
     """
-    if len(self.input_sequence) == 0:
+    try:
+      line = self.input_sequence[self.input_position]
+    except IndexError:
       raise StopIteration()
 
-    return self.input_sequence.pop()
+    self.input_position += 1
+    return line
+
+  def consume(self, n = 1):
+    """Consume the next `n` lines of input, which have already been peeked.
+
+    Raises:
+      AssertionError : If there are fewer than `n` lines of input left.
+    """
+    assert self.input_position + n <= len(self.input_sequence),  \
+      ("Input ended while consuming {0} peeked lines.").format(n)
+
+    self.input_position += n
 
   # Lookahead at the (n + 1)th line. 
   def __getitem__(self, n):
@@ -546,11 +633,28 @@ class io_manager(object):
     Returns:
       The `(n + 1)`th line of input if it exists, otherwise an empty `str`.
     """
-    if len(self.input_sequence) <= n:
+    try:
+      return self.input_sequence[self.input_position + n]
+    except IndexError:
       # We don't want to terminate on a peek.
       return ''
 
-    return self.input_sequence[-(n + 1)]
+  def find(self, line, n = 0):
+    """Find the next line of input equal to `line`, starting at the `(n + 1)`th
+    line, without consuming any input.
+
+    The search is done by `list.index`, so it does not run any Python code per
+    line.
+
+    Returns:
+      The smallest `m >= n` such that `self[m] == line`, or the number of
+      lines of input remaining if there is no such line.
+    """
+    try:
+      return self.input_sequence.index(line, self.input_position + n) \
+           - self.input_position
+    except ValueError:
+      return len(self.input_sequence) - self.input_position
 
   #############################################################################
   # Output
@@ -559,8 +663,26 @@ class io_manager(object):
     """Write a string to the output TSV file.
 
     This is a requirement for the `Printable` protocol.
+
+    The string is buffered; it is written once `output_batch_size` bytes have
+    accumulated or when `flush` is called.
     """
-    self.output_tsv_file.write(s)
+    self.output_sequence.append(s)
+    self.output_sequence_size += len(s)
+
+    if self.output_sequence_size >= self.output_batch_size:
+      self.write_output_sequence()
+
+  def write_output_sequence(self):
+    """Write all pending output to the output TSV file."""
+    self.output_tsv_file.write("".join(self.output_sequence))
+    del self.output_sequence[:]
+    self.output_sequence_size = 0
+
+  def flush(self):
+    """Write all pending output to the output TSV file and flush it."""
+    self.write_output_sequence()
+    self.output_tsv_file.flush()
 
   #############################################################################
   # Month to Year Mapping
@@ -578,11 +700,13 @@ class io_manager(object):
     Raises:
       AssertionError : If `type(t)` is not `month_day_year` or `period`.
     """
+    self.dates.clear()
+
     if   type(t) is month_day_year:
       self.month_year_mapping[t.month] = t.year
     elif type(t) is period:
-      self.add_month_year_mapping(t.opening)
-      self.add_month_year_mapping(t.closing)
+      self.month_year_mapping[t.opening.month] = t.opening.year
+      self.month_year_mapping[t.closing.month] = t.closing.year
     else:
       assert False,                                                            \
         ("Cannot add `{0}` of type `{1}` to the month year mapping because " + \
@@ -600,21 +724,40 @@ class io_manager(object):
     Raises:
       AssertionError : If there is no month to year mapping for `date.month`.
     """
-    year = None
+    year = self.month_year_mapping[date.month]
 
-    if date.month in self.month_year_mapping:
-      year = self.month_year_mapping[date.month]
-    else:
+    if year is None:
       # There is usually 1 year in the mapping and at most there are 2 years
       # for a January statement. In the case of a January statement, if the
       # year of the transaction is the later year, it most have been a
       # transaction in January, and thus it would be in the mapping. So, the
       # correct year must be the earlier year. In all other cases, there is
       # only one year in the mapping, so the earlier year is correct.
-      year = min(self.month_year_mapping.values())
+      year = min(filter(lambda year: year is not None, self.month_year_mapping))
 
     return month_day_year(date.month, date.day, year)
 
+  def date(self, month, day):
+    """Get the `month_day_year` for a MM/DD date using the month to year mapping.
+
+    The result is memoized, so the same object is returned for every
+    transaction on the same date.
+
+    Returns:
+      A `month_day_year` object with the month `month` and the day `day`.
+    """
+    key = (month, day)
+
+    try:
+      return self.dates[key]
+    except KeyError:
+      pass
+
+    date = self.add_year(month_day(month, day))
+
+    self.dates[key] = date
+    return date
+
 ###############################################################################
 
 class period_meta_data_record_parser(object):
@@ -626,45 +769,50 @@ class period_meta_data_record_parser(object):
   ############################################################################
   # Grammar
 
-  # Parse two consecutive digits.
-  two_digits_rule = r'[0-9]{2}'
+  # A statement period line has a fixed layout:
+  #
+  #   Opening/Closing Date MM/DD/YY - MM/DD/YY
+  #
+  # So instead of a regular expression, we check the prefix and the length,
+  # then slice the dates at their known offsets.
 
-  # Parse a date in MM/DD/YY format.
-  month_day_year_rule = r'(' + two_digits_rule + r')/' \
-                      + r'(' + two_digits_rule + r')/' \
-                      + r'(' + two_digits_rule + r')'
+  # The text preceding the dates.
+  period_meta_data_prefix = "Opening/Closing Date "
 
-  # Parse a statement period line.
-  period_meta_data_rule = r'Opening/Closing Date '  \
-                        + month_day_year_rule       \
-                        + r' - '                    \
-                        + month_day_year_rule       \
-                        + r'$'
+  # The length of a statement period line.
+  period_meta_data_length = len(period_meta_data_prefix) \
+                          + len("MM/DD/YY - MM/DD/YY")
 
-  period_meta_data_engine = regex_compile(period_meta_data_rule)
-   
   #############################################################################
 
   def __call__(self, iom, action = lambda iom, value: None):
-    match = self.period_meta_data_engine.match(iom[0])
+    line = iom[0]
+
+    if len(line) != self.period_meta_data_length or \
+       not line.startswith(self.period_meta_data_prefix):
+      return False
 
-    if match is None:
+    # "MM/DD/YY - MM/DD/YY"
+    dates  = line[len(self.period_meta_data_prefix):]
+
+    # "MMDDYYMMDDYY"
+    digits = dates[0:2]   + dates[3:5]   + dates[6:8] \
+           + dates[11:13] + dates[14:16] + dates[17:19]
+
+    if not digits.isdigit()                                    or \
+       not dates[2] == dates[5] == dates[13] == dates[16] == "/" or \
+       not dates[8:11] == " - ":
       return False
 
     # We matched, so we consume the input.
-    try:
-      iom.next()
-    except StopIteration:
-      assert False,                                                         \
-        "Input ended while consuming peeked lines after period meta-data" + \
-        "record match."
+    iom.consume()
 
-    opening = month_day_year(int(match.group(1)),
-                             int(match.group(2)),
-                             int(match.group(3)))
-    closing = month_day_year(int(match.group(4)),
-                             int(match.group(5)),
-                             int(match.group(6)))
+    opening = month_day_year(two_digits_to_int(digits[0:2]),
+                             two_digits_to_int(digits[2:4]),
+                             two_digits_to_int(digits[4:6]))
+    closing = month_day_year(two_digits_to_int(digits[6:8]),
+                             two_digits_to_int(digits[8:10]),
+                             two_digits_to_int(digits[10:12]))
 
     action(iom, period(opening, closing))
 
@@ -693,10 +841,15 @@ class non_transaction_record_parser(always_match_parser):
   `Action` after escaping it.
   """
   def __call__(self, iom, action = lambda iom, value: None):
-    return super(non_transaction_record_parser, self).__call__(
-        iom
-      , lambda iom, value: action(iom, escape_str(value))
-    )
+    # Most lines are non-transaction records, so this is implemented directly
+    # instead of wrapping `action` and calling the base class.
+    try:
+      line = iom.next()
+    except StopIteration:
+      return False
+
+    action(iom, escape_str(line))
+    return True
 
 ###############################################################################
 
@@ -709,26 +862,24 @@ class transaction_header_record_parser(object):
   This parser uses simple string comparisons instead of regular expressions.
   """
 
-  def __call__(self, iom, action = lambda iom: None):
-    if iom[0] == "Date of":
-      # Likely the start of a transaction header record, lookahead to the next line.
-      if iom[1] == "Transaction Merchant Name or Transaction Description $ Amount":
-        # We matched the second header line. We just need to consume the input,
-        # call our action, and return True.
-
-        try:
-          action(iom, iom.next() + "\\n" + iom.next())
-        except StopIteration:
-          assert False,                                                     \
-            "Input ended while consuming peeked lines after transaction " + \
-            "header record match."
-
-        return True
+  # The two lines of a transaction header record.
+  first_line  = "Date of"
+  second_line = "Transaction Merchant Name or Transaction Description $ Amount"
 
-    else:
+  def __call__(self, iom, action = lambda iom, value: None):
+    # `or` short-circuits, so we only peek at the 2nd line if the 1st matched.
+    if iom[0] != self.first_line or iom[1] != self.second_line:
       # No match. 
       return False
 
+    # We matched both header lines. We just need to consume the input, call our
+    # action, and return True.
+    iom.consume(2)
+
+    action(iom, self.first_line + "\\n" + self.second_line)
+
+    return True
+
 ###############################################################################
 
 class transaction_record_parser(object):
@@ -757,14 +908,15 @@ class transaction_record_parser(object):
   # Parse three consecutive capital letters.
   three_capital_letters_rule = r'[A-Z]{3}'
 
-  # Parse two consecutive digits.
-  two_digits_rule = r'[0-9]{2}'
-
   # Parse a date in MM/DD format.
   month_day_rule = r'(' + two_digits_rule + r')/(' + two_digits_rule + r')'
 
   # Parse a transaction description.
   transaction_description_rule = r'(.*)'
+  # This is greedy on purpose. In a transaction record line, it is followed by
+  # the amount, which is anchored at the end of the line, so the engine only
+  # backtracks over the amount. A non-greedy rule would retry the rest of the
+  # pattern at every character of the description instead.
 
   # Parse a number in N,NNN.NN format.
   positive_quantity_rule = r'[0-9]{1,3}(?:' + r',' + r'[0-9]{3})*' + r'.' + '[0-9]*'
@@ -780,14 +932,12 @@ class transaction_record_parser(object):
                                    + r' '                         \
                                    + transaction_description_rule \
                                    + r' '                         \
-                                   + transaction_amount_rule      \
-                                   + r'$'
+                                   + transaction_amount_rule
 
   # Parse an exchange date and currency line.
   exchange_date_and_currency_rule = month_day_rule                \
                                   + r' '                          \
-                                  + transaction_description_rule  \
-                                  + r'$'
+                                  + transaction_description_rule
   # There is no lookahead assertion here, so this will match a domestic
   # transaction record. First we lookahead and check the exchange rate line
   # (the 3rd line in a foreign transaction record), which is not ambiguous with
@@ -804,7 +954,7 @@ class transaction_record_parser(object):
   exchange_rate_calculation_rule = exchange_amount_rule   \
                                  + r' X '                 \
                                  + exchange_rate_rule     \
-                                 + r' [(]EXCHG RATE[)]$'
+                                 + r' [(]EXCHG RATE[)]'
 
   # Parse a transit index.
   transit_index_rule = one_digit_rule
@@ -824,8 +974,10 @@ class transaction_record_parser(object):
                    + r' '                   \
                    + transit_location_rule  \
                    + r' '                   \
-                   + transit_location_rule  \
-                   + r'$'
+                   + transit_location_rule
+
+  # Length of a transit leg line, e.g. "1 Y JFK ATL".
+  transit_leg_length = 11
 
   # Parse a transit id.
   transit_id_rule = r'(' + six_digits_rule + r')'
@@ -833,72 +985,113 @@ class transaction_record_parser(object):
   # Parse a transit id followed by a transit leg.
   transit_leg_with_id_rule = transit_id_rule + r' ' + transit_leg_rule
 
-  domestic_transaction_record_engine = regex_compile(domestic_transaction_record_rule)
-  exchange_date_and_currency_engine  = regex_compile(exchange_date_and_currency_rule)
-  exchange_rate_calculation_engine   = regex_compile(exchange_rate_calculation_rule)
-  transit_leg_engine                 = regex_compile(transit_leg_rule)
-  transit_leg_with_id_engine         = regex_compile(transit_leg_with_id_rule)
+  # Parse the lines that follow the 1st line of a transaction record. This is
+  # matched against the next two lines of input joined by a newline character,
+  # so a single match tells us whether and how the transaction record
+  # continues. The name of the alternative that matched is one of:
+  #
+  #   exchange_info             : The 2nd and 3rd lines of a foreign
+  #                               transaction record (groups 2-6).
+  #   transit_info              : The 2nd line of a transit transaction record
+  #                               (groups 8-11).
+  #   exchange_rate_calculation : An exchange rate calculation line that is not
+  #                               preceded by an exchange date and currency
+  #                               line (malformed input).
+  continuation_rule = r'(?P<exchange_info>'                          \
+                    +   exchange_date_and_currency_rule              \
+                    +   r'\n'                                        \
+                    +   exchange_rate_calculation_rule               \
+                    + r'$)'                                          \
+                    + r'|(?P<transit_info>'                          \
+                    +   transit_leg_with_id_rule                     \
+                    + r'\n)'                                         \
+                    + r'|(?P<exchange_rate_calculation>'             \
+                    +   r'[^\n]*\n'                                  \
+                    +   exchange_rate_calculation_rule               \
+                    + r'$)'
+
+  domestic_transaction_record_engine = regex_compile(domestic_transaction_record_rule + r'$')
+  continuation_engine                = regex_compile(continuation_rule)
+  transit_leg_engine                 = regex_compile(transit_leg_rule + r'$')
+
+  # The bound match methods of the engines, so that each record only has to
+  # look up one attribute instead of two.
+  domestic_transaction_record_matcher = domestic_transaction_record_engine.match
+  continuation_matcher                = continuation_engine.match
+  transit_leg_matcher                 = transit_leg_engine.match
 
   #############################################################################
 
   def __call__(self, iom, action = lambda iom, value: None):
-    domestic_match = self.domestic_transaction_record_engine.match(iom[0])
+    line = iom[0]
+
+    # Most lines are not transaction records. Every transaction record line
+    # starts with "MM/DD ", so check the separators before running the regex.
+    if line[2:3] != "/" or line[5:6] != " ":
+      return False
+
+    domestic_match = self.domestic_transaction_record_matcher(line)
 
     if domestic_match is None:
       return False
 
     # We matched, so we consume the input.
-    try:
-      iom.next()
-    except StopIteration:
-      assert False,                                                  \
-        "Input ended while consuming peeked lines after domestic " + \
-        "transaction record match."
+    iom.consume()
 
-    date        = iom.add_year(month_day(int(domestic_match.group(1)),
-                                         int(domestic_match.group(2))))
-    description = escape_str(domestic_match.group(3))
-    amount      = str_to_float(domestic_match.group(4))
+    (month, day, description, amount) = domestic_match.groups()
+
+    date        = iom.date(two_digits_to_int(month), two_digits_to_int(day))
+    description = escape_str(description)
+    amount      = str_to_float(amount)
 
     # The 1st line of a foreign transaction record has the same format as a
     # domestic transaction record, and the 2nd line of a foreign transaction
     # record requires an in-line lookahead to disambiguate it from a
     # domestic transaction record. The 3rd line requires no in-line
-    # lookahead to disambiguate, so we check the 3rd line to determine if
-    # the transaction record is foreign or domestic.
-    foreign3_match = self.exchange_rate_calculation_engine.match(iom[1])
-
-    if foreign3_match is not None:
-      # Foreign transaction record (probably).
-
-      # Confirm that this is a foreign transaction record by checking the
-      # 2nd line.
-      foreign2_match = self.exchange_date_and_currency_engine.match(iom[0])
-
-      assert foreign2_match is not None,                                   \
-        ("Foreign transaction record 1st line (date, description and "   + \
-         "amount) `{0}` and 3rd line (exchange rate calculation) `{2}` " + \
-         "matched, but 2nd line (exchange date and currency) `{1}` did " + \
-         "not.").format(domestic_match.string, iom[0], iom[1])
-
-      # Now we definitely have a foreign transaction record, so we consume the
-      # two lines we peeked. 
-      try:
-        iom.next()
-        iom.next()
-      except StopIteration:
-        assert False,                                                 \
-          "Input ended while consuming peeked lines after foreign " + \
-          "transaction record match."
+    # lookahead to disambiguate, so we match the 2nd and 3rd lines together
+    # to determine if the transaction record is foreign, transit or domestic.
+    #
+    # Usually the next line is just another transaction record. Every
+    # continuation either ends its 2nd line with the exchange rate suffix or
+    # starts its 1st line with a six digit transit id and a space, so check
+    # those before joining the lines and running the regex.
+    second_line = iom[0]
+    third_line  = iom[1]
+
+    continuation_match = None
+    continuation       = None
+
+    if third_line.endswith(" (EXCHG RATE)") or second_line[6:7] == " ":
+      continuation_match = self.continuation_matcher(
+          second_line + "\n" + third_line
+      )
+
+      if continuation_match is not None:
+        continuation = continuation_match.lastgroup
+
+    assert continuation != "exchange_rate_calculation",                    \
+      ("Foreign transaction record 1st line (date, description and "   + \
+       "amount) `{0}` and 3rd line (exchange rate calculation) `{2}` " + \
+       "matched, but 2nd line (exchange date and currency) `{1}` did " + \
+       "not.").format(line, second_line, third_line)
+
+    if continuation == "exchange_info":
+      # Foreign transaction record.
+
+      # We consume the two lines we peeked. 
+      iom.consume(2)
 
       # MM/DD to MM/DD/YY conversion is done in the statement_parser, to keep
       # transaction_record_parser from needing tight coupling with
       # period_meta_data_record_parser.
-      exchange_date     = iom.add_year(month_day(int(foreign2_match.group(1)),
-                                                 int(foreign2_match.group(2))))
-      exchange_currency = escape_str(foreign2_match.group(3))
-      exchange_amount   = str_to_float(foreign3_match.group(1))
-      exchange_rate     = str_to_float(foreign3_match.group(2))
+      (exchange_month, exchange_day, exchange_currency,
+       exchange_amount, exchange_rate) = continuation_match.group(2, 3, 4, 5, 6)
+
+      exchange_date     = iom.date(two_digits_to_int(exchange_month),
+                                   two_digits_to_int(exchange_day))
+      exchange_currency = escape_str(exchange_currency)
+      exchange_amount   = str_to_float(exchange_amount)
+      exchange_rate     = str_to_float(exchange_rate)
 
       action(iom, foreign_transaction_record(date, description, amount,
                                              exchange_date, exchange_currency,
@@ -907,46 +1100,43 @@ class transaction_record_parser(object):
     else:
       # Domestic or transit transaction record.
 
-      # Check if the next line is transit info.
-      transit2_match = self.transit_leg_with_id_engine.match(iom[0])
-
-      if transit2_match is not None:
+      if continuation == "transit_info":
         # We definitely have a transit transaction record with at least 2 lines,
         # so consume the 2nd line that we peeked.
-        try:
-          iom.next()
-        except StopIteration:
-          assert False,                                                 \
-            "Input ended while consuming peeked lines after transit " + \
-            "transaction record match."
+        iom.consume()
+
+        (transit_id, code, departure, arrival) = \
+          continuation_match.group(8, 9, 10, 11)
 
-        transit_id = int(transit2_match.group(1))
+        transit_id = int(transit_id)
 
         transit_legs = [
-          transit_leg(transit2_match.group(2),
-                      transit2_match.group(3),
-                      transit2_match.group(4))
+          transit_leg(code, departure, arrival)
         ]
 
-        # Now, iteratively match any additional transit leg lines.
+        # Bind the methods used in the loop below to locals, so that each
+        # iteration doesn't have to look them up again.
+        transit_leg_match  = self.transit_leg_matcher
+        transit_leg_length = self.transit_leg_length
+        peek               = iom.__getitem__
+        consume            = iom.consume
+        append_transit_leg = transit_legs.append
+
+        # Now, iteratively match any additional transit leg lines. Transit leg
+        # lines have a fixed length, so check that before running the regex.
         while True:
-          transitN_match = self.transit_leg_engine.match(iom[0])
+          transitN_line  = peek(0)
+          transitN_match = None
+
+          if len(transitN_line) == transit_leg_length:
+            transitN_match = transit_leg_match(transitN_line)
 
           if transitN_match is not None:
             # We matched so consume the line.
-            try:
-              iom.next()
-            except StopIteration:
-              assert False,                                                 \
-                "Input ended while consuming peeked lines after transit " + \
-                "transaction record match."
+            consume()
 
             # Add the transit leg to the list.
-            transit_legs.append(
-              transit_leg(transitN_match.group(1),
-                          transitN_match.group(2),
-                          transitN_match.group(3))
-            )
+            append_transit_leg(transit_leg(*transitN_match.groups()))
           else:
             # No match, so that's the end of the transit transaction record and
             # we need to break out of the while loop.
@@ -980,9 +1170,15 @@ class record_parser(enum(
 
   Attributes:
     state             (enum) : The current state of the parser.
+    state_parsers     (list) : The method that parses each state, indexed by
+      state.
     meta_data_parsers (list) : A list of meta-data parsers to run. They are
       stored in reverse order so that the next meta-data parser can be popped
       from the end of the list instead of the beginning.
+    non_transaction_lookahead (int) : The number of upcoming lines that are
+      known to be non-transaction records in the non-transaction state.
+    bound_actions     (dict) : The actions created by `bind_action`, keyed by
+      the sub-parser, user action and our action they were created for.
   """
 
   # Non-transaction parsers.
@@ -1002,77 +1198,141 @@ class record_parser(enum(
         (period_meta_data_record_parser(), io_manager.add_month_year_mapping)
     ]))
 
+    # In the non-transaction state, the lines before the next possible
+    # transaction header record can only be non-transaction records. We count
+    # them down instead of trying the transaction header record parser on each.
+    self.non_transaction_lookahead = 0
+
+    # Actions created by `bind_action`, so that we don't create a new closure
+    # for every record.
+    self.bound_actions = {}
+
+    # Dispatch table of the method that parses each state. States are integers
+    # numbered in the order they are declared, so this is indexed by state.
+    self.state_parsers = [
+        self.parse_meta_data_state       # META_DATA_STATE
+      , self.parse_non_transaction_state # NON_TRANSACTION_STATE
+      , self.parse_pre_transaction_state # PRE_TRANSACTION_STATE
+      , self.parse_transaction_state     # TRANSACTION_STATE
+    ]
+
   def bind_action(self, sub_parser, user_action,
                                     our_action = lambda iom, value: None):
     """Create a single action that invokes `user_action` and `our_action`.
 
     `user_action` is passed the parser state (`self.state`) and `sub_parser`
     when called.
+
+    The same actions are bound for every record, so the bound action is
+    created once for each combination and reused afterwards.
     """
-    def binder(self, sub_parser, iom, user_action, our_action, value):
+    key = (sub_parser, user_action, our_action)
+
+    try:
+      return self.bound_actions[key]
+    except KeyError:
+      pass
+
+    # This is called for every record, so the closure calls both actions itself
+    # instead of forwarding its arguments to a helper function.
+    def bound_action(iom, value):
       our_action(iom, value)
       user_action(iom, (self.state, sub_parser, value))
-    return lambda iom, value: binder(self, sub_parser, iom,           \
-                                     user_action, our_action, value)
 
-  def __call__(self, iom, action = lambda iom, value: None):
-    if   self.state == self.META_DATA_STATE:
-      assert len(self.meta_data_parsers) > 0,                            \
-        "`record_parser` is in META_DATA_STATE but there are no more " + \
-        "meta-data parsers."
-
-      (meta_data_parser, meta_data_action) = self.meta_data_parsers[-1]
-
-      # Wrap the user-specified action and the meta-data action. 
-      bound_action = self.bind_action(meta_data_parser, action, meta_data_action)
-
-      # Try to match with the current meta-data parser.
-      if meta_data_parser(iom, bound_action):
-        # We matched, so pop the meta-data parser.
-        self.meta_data_parsers.pop()
-
-        if len(self.meta_data_parsers) == 0:
-          # We don't have any more meta-data parsers to run, so switch to the
-          # non-transaction state.
-          self.state = self.NON_TRANSACTION_STATE
-
-        return True
-
-    elif self.state == self.NON_TRANSACTION_STATE:
-      # Wrap the user-specified action to pass it the parser state and sub-parser.
-      bound_action = self.bind_action(self.parse_transaction_header_record, action)
-
-      # Try to match with the transaction header record parser.
-      if self.parse_transaction_header_record(iom, bound_action):
-        # We matched, so switch to the pre-transaction state.
-        self.state = self.PRE_TRANSACTION_STATE
-        return True
-
-    elif self.state == self.PRE_TRANSACTION_STATE:
-      # Wrap the user-specified action to pass it the parser state and sub-parser.
-      bound_action = self.bind_action(self.parse_transaction_record, action)
-
-      # Try to match with the transaction record parser.
-      if self.parse_transaction_record(iom, bound_action):
-        # We matched, so switch to the transaction state.
-        self.state = self.TRANSACTION_STATE
-        return True
-
-    elif self.state == self.TRANSACTION_STATE:
-      # Wrap the user-specified action to pass it the parser state and sub-parser.
-      bound_action = self.bind_action(self.parse_transaction_record, action)
-
-      # Try to match with the transaction record parser.
-      if self.parse_transaction_record(iom, bound_action):
-        # We didn't fail, so we stay in the transaction state. 
-        return True
-      else:
-        # We failed, so we switch to the non-transaction state.
+    self.bound_actions[key] = bound_action
+    return bound_action
+
+  #############################################################################
+  # States
+  #
+  # Each state has a method that tries the parsers specific to that state. It
+  # returns True if one of them matched and False otherwise, in which case
+  # `__call__` falls back to the non-transaction record parser.
+
+  def parse_meta_data_state(self, iom, action):
+    assert len(self.meta_data_parsers) > 0,                            \
+      "`record_parser` is in META_DATA_STATE but there are no more " + \
+      "meta-data parsers."
+
+    (meta_data_parser, meta_data_action) = self.meta_data_parsers[-1]
+
+    # Wrap the user-specified action and the meta-data action. 
+    bound_action = self.bind_action(meta_data_parser, action, meta_data_action)
+
+    # Try to match with the current meta-data parser.
+    if meta_data_parser(iom, bound_action):
+      # We matched, so pop the meta-data parser.
+      self.meta_data_parsers.pop()
+
+      if len(self.meta_data_parsers) == 0:
+        # We don't have any more meta-data parsers to run, so switch to the
+        # non-transaction state.
         self.state = self.NON_TRANSACTION_STATE
 
-    else:
+      return True
+
+    return False
+
+  def parse_non_transaction_state(self, iom, action):
+    if self.non_transaction_lookahead > 0:
+      # We already know that this is a non-transaction record.
+      self.non_transaction_lookahead -= 1
+      return False
+
+    # Wrap the user-specified action to pass it the parser state and sub-parser.
+    bound_action = self.bind_action(self.parse_transaction_header_record, action)
+
+    # Try to match with the transaction header record parser.
+    if self.parse_transaction_header_record(iom, bound_action):
+      # We matched, so switch to the pre-transaction state.
+      self.state = self.PRE_TRANSACTION_STATE
+      return True
+
+    # The current line will be consumed as a non-transaction record. Find the
+    # next line that could start a transaction header record; every line in
+    # between is a non-transaction record too.
+    self.non_transaction_lookahead = iom.find(
+        self.parse_transaction_header_record.first_line, 1
+    ) - 1
+
+    return False
+
+  def parse_pre_transaction_state(self, iom, action):
+    # Wrap the user-specified action to pass it the parser state and sub-parser.
+    bound_action = self.bind_action(self.parse_transaction_record, action)
+
+    # Try to match with the transaction record parser.
+    if self.parse_transaction_record(iom, bound_action):
+      # We matched, so switch to the transaction state.
+      self.state = self.TRANSACTION_STATE
+      return True
+
+    return False
+
+  def parse_transaction_state(self, iom, action):
+    # Wrap the user-specified action to pass it the parser state and sub-parser.
+    bound_action = self.bind_action(self.parse_transaction_record, action)
+
+    # Try to match with the transaction record parser.
+    if self.parse_transaction_record(iom, bound_action):
+      # We didn't fail, so we stay in the transaction state. 
+      return True
+
+    # We failed, so we switch to the non-transaction state.
+    self.state = self.NON_TRANSACTION_STATE
+    return False
+
+  #############################################################################
+
+  def __call__(self, iom, action = lambda iom, value: None):
+    try:
+      parse_state = self.state_parsers[self.state]
+    except IndexError:
       assert False, ("Parser state `{0}` is invalid.").format(self.state)
 
+    if parse_state(iom, action):
+      return True
+
     # We didn't match anything else, so we must be on a non-transaction record
     # or out of input.
 
@@ -1098,17 +1358,22 @@ iom = io_manager(args.input_pdf, args.output_tsv)
 p = record_parser()
 
 # Print the TSV header.
+#
+# We write whole lines to `iom` directly instead of using `print`, which writes
+# the trailing newline separately and maintains the `softspace` state.
 if args.header and not args.debug:
-  print >> iom, "Transaction Type\t"                                            + \
-                "Transaction Date\t"                                            + \
-                "Transaction Description\t"                                     + \
-                "Amount [Domestic Currency]\t"                                  + \
-                "Currency Exchange Date\t"                                      + \
-                "Foreign Currency\t"                                            + \
-                "Amount [Foreign Currency]\t"                                   + \
-                "Currency Exchange Rate [Foreign Currency/Domestic Currency]\t" + \
-                "Transit ID\t"                                                  + \
-                "Transit Legs"
+  iom.write("\t".join([
+      "Transaction Type"
+    , "Transaction Date"
+    , "Transaction Description"
+    , "Amount [Domestic Currency]"
+    , "Currency Exchange Date"
+    , "Foreign Currency"
+    , "Amount [Foreign Currency]"
+    , "Currency Exchange Rate [Foreign Currency/Domestic Currency]"
+    , "Transit ID"
+    , "Transit Legs"
+  ]) + "\n")
 
 action = None
 
@@ -1116,7 +1381,7 @@ if args.debug:
   # Debug output mode: print debug info and all records.
   def print_any_record(iom, tup):
     (state, sub_parser, value) = tup
-    print >> iom, "{0}\t{1}\t{2}".format(state, sub_parser, value)
+    iom.write("{0}\t{1}\t{2}\n".format(state, sub_parser, value))
 
   action = print_any_record
 
@@ -1124,11 +1389,19 @@ else:
   # Regular output mode: print transaction records only.
   def print_transaction_record(iom, tup):
     (state, sub_parser, value) = tup
-    if type(sub_parser) == transaction_record_parser:
-      print >> iom, value
+    if sub_parser is p.parse_transaction_record:
+      iom.write(str(value) + "\n")
 
   action = print_transaction_record
 
 # Parse the input and output as we go.
-while p(iom, action): pass
+#
+# Pending output is written out explicitly, rather than at exit, so that a
+# failed write raises and the program exits with a non-zero status. It is done
+# in a `finally` so that the output parsed before a malformed record is still
+# written when the parser fails.
+try:
+  while p(iom, action): pass
+finally:
+  iom.flush()
 